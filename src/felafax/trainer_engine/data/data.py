@@ -1,5 +1,7 @@
 # base.py
-from dataclasses import dataclass
+import os
+import warnings
+from dataclasses import dataclass, field
 from functools import partial
 from pathlib import Path
 from typing import Any, Callable, Dict, List, Optional, Union, Tuple
@@ -10,6 +12,16 @@ from torch.utils.data import DataLoader, Dataset
 from transformers import PreTrainedTokenizerBase
 
 
+def _default_num_workers(max_workers: int = 16) -> int:
+    """One DataLoader worker per CPU core available to this process, capped
+    at `max_workers`."""
+    if hasattr(os, "sched_getaffinity"):
+        num_cpus = len(os.sched_getaffinity(0))
+    else:
+        num_cpus = os.cpu_count() or 1
+    return min(num_cpus, max_workers)
+
+
 @dataclass
 class DatasetConfig:
     """Configuration for datasets."""
@@ -24,7 +36,18 @@ class DatasetConfig:
     # Processing parameters
     batch_size: int = 32
     max_seq_length: int = 64
-    num_workers: int = 4
+    # Defaults to one worker per available CPU core, capped at 16.
+    num_workers: int = field(default_factory=_default_num_workers)
+    # Keep workers alive across epochs instead of re-spawning them (and
+    # re-importing the tokenizer) at the start of every epoch.
+    persistent_workers: bool = True
+    # Pinned host memory speeds up host-to-accelerator copies. torch can only
+    # pin memory when an accelerator backend is present, so None enables it
+    # automatically in that case.
+    pin_memory: Optional[bool] = None
+    # Batches prefetched per worker. Keep this small: every prefetched batch
+    # holds on to (pinned) host memory until it is consumed.
+    prefetch_factor: int = 2
     ignore_index: int = -100
     mask_prompt: bool = False
     pad_id: int = 0
@@ -76,11 +99,22 @@ def create_dataloader(
     shuffle: bool = False,
 ) -> DataLoader:
     """Creates a DataLoader for the given dataset."""
+    pin_memory = config.pin_memory
+    if pin_memory is None:
+        pin_memory = torch.cuda.is_available()
+
+    use_workers = config.num_workers > 0
+    if use_workers:
+        _warn_if_prefetch_exceeds_memory(config)
+
     return DataLoader(
         dataset,
         batch_size=config.batch_size,
         shuffle=shuffle,
         num_workers=config.num_workers,
+        persistent_workers=config.persistent_workers and use_workers,
+        pin_memory=pin_memory,
+        prefetch_factor=config.prefetch_factor if use_workers else None,
         collate_fn=get_sft_collate_fn(
             max_seq_length=config.max_seq_length,
             pad_id=config.pad_id,
@@ -89,9 +123,45 @@ def create_dataloader(
     )
 
 
+def _warn_if_prefetch_exceeds_memory(
+    config: DatasetConfig, max_memory_fraction: float = 0.1
+) -> None:
+    """Warns if batches prefetched by the DataLoader workers could use more
+    than `max_memory_fraction` of the host's physical memory."""
+    try:
+        total_memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        return
+
+    # input_ids and labels, 4 bytes (int32) per token each.
+    prefetch_bytes = (
+        config.num_workers
+        * config.prefetch_factor
+        * config.batch_size
+        * max(config.max_seq_length, 0)
+        * 2
+        * 4
+    )
+    if prefetch_bytes > max_memory_fraction * total_memory:
+        warnings.warn(
+            f"DataLoader workers may prefetch up to {prefetch_bytes / 2**30:.1f} "
+            f"GiB of batches ({config.num_workers} workers x prefetch_factor "
+            f"{config.prefetch_factor}), more than {max_memory_fraction:.0%} of "
+            "host memory. Consider reducing num_workers or prefetch_factor."
+        )
+
+
 class SFTDataset(Dataset):
     """Dataset for Supervised Fine-Tuning (SFT)."""
 
+    # Format string used by the default `apply_format`. `{input}` is replaced
+    # with the example's `dataset_input_field`.
+    prompt_template: str = (
+        "Below is an instruction that describes a task. "
+        "Write a response that appropriately completes the request.\n\n"
+        "### Instruction:\n{input}\n\n### Response:\n"
+    )
+
     def __init__(
         self,
         config: DatasetConfig,
@@ -112,73 +182,91 @@ class SFTDataset(Dataset):
             else self.tokenizer.pad_token_id
         )
 
+        # Tokenize the whole dataset once, up front. Tokenizers are much
+        # faster on a list of strings than on one string at a time, and this
+        # avoids re-tokenizing every example on every epoch.
+        prompts, responses = [], []
+        for example in self.data:
+            if self.transform:
+                example = self.transform(example)
+            prompt, response = self.apply_format(example)
+            prompts.append(prompt)
+            responses.append(response)
+
+        self.encoded_prompts = self._batch_encode(
+            prompts, add_special_tokens=True
+        )
+        self.encoded_responses = self._batch_encode(
+            responses, add_special_tokens=False
+        )
+
+        # Pad all examples once into a contiguous (num_examples, seq_length)
+        # buffer, so that collating a batch is a single stack of rows. Labels
+        # are not stored: the collate function derives them from the input ids
+        # and each example's label span.
+        sequences = [
+            (encoded_prompt + encoded_response + [self.eos_token_id])
+            for encoded_prompt, encoded_response in zip(
+                self.encoded_prompts, self.encoded_responses
+            )
+        ]
+        if self.max_seq_length > 0:
+            seq_length = self.max_seq_length
+        else:
+            seq_length = max((len(seq) for seq in sequences), default=0)
+
+        self.input_ids = torch.full(
+            (len(sequences), seq_length), config.pad_id, dtype=torch.int32
+        )
+        for idx, sequence in enumerate(sequences):
+            # Truncate the combined sequence to seq_length if necessary
+            sequence = torch.tensor(sequence[:seq_length], dtype=torch.int32)
+            self.input_ids[idx, : len(sequence)] = sequence
+
+    def _batch_encode(
+        self, texts: List[str], add_special_tokens: bool
+    ) -> List[List[int]]:
+        """Tokenizes a list of texts in a single batched tokenizer call."""
+        if not texts:
+            return []
+        truncation_kwargs = (
+            {"max_length": self.max_seq_length, "truncation": True}
+            if self.max_seq_length > 0
+            else {}
+        )
+        return self.tokenizer(
+            texts,
+            add_special_tokens=add_special_tokens,
+            **truncation_kwargs,
+        )["input_ids"]
+
     def apply_format(self, example: Dict[str, Any]) -> Tuple[str, str]:
         """Default method to apply prompt formatting. Returns prompt and response.
 
-        Override this method in subclasses for custom behavior.
+        Override `prompt_template` to change the prompt, or this method in
+        subclasses for custom behavior. Called once per example, when the
+        dataset is built.
         """
         input_prompt = example[self.config.dataset_input_field]
         response_prompt = example[self.config.dataset_output_field]
 
-        prompt = (
-            "Below is an instruction that describes a task. "
-            "Write a response that appropriately completes the request.\n\n"
-            f"### Instruction:\n{input_prompt}\n\n### Response:\n"
-        )
+        prompt = self.prompt_template.format_map({"input": input_prompt})
         return prompt, response_prompt
 
     def __len__(self) -> int:
         return len(self.data)
 
     def __getitem__(self, idx: int) -> Dict[str, Any]:
-        example = self.data[idx]
-
-        if self.transform:
-            example = self.transform(example)
-
-        # Apply the prompt formatting
-        prompt, response = self.apply_format(example)
-
-        # Encode the prompt with special tokens
-        encoded_prompt = self.tokenizer.encode(
-            prompt,
-            add_special_tokens=True,
-            max_length=self.max_seq_length,
-            truncation=True,
-        )
-
-        # Encode the response without adding special tokens
-        encoded_response = self.tokenizer.encode(
-            response,
-            add_special_tokens=False,
-            max_length=self.max_seq_length,
-            truncation=True,
-        )
-
-        # Concatenate the encoded prompt and response
-        encoded_prompt_and_response = (
-            encoded_prompt + encoded_response + [self.eos_token_id]
-        )
-
-        # Truncate the combined sequence to the max_seq_length if necessary
-        if self.max_seq_length > 0:
-            encoded_prompt_and_response = encoded_prompt_and_response[
-                : self.max_seq_length
-            ]
-
-        # Convert to torch tensor
-        input_ids = torch.tensor(encoded_prompt_and_response, dtype=torch.long)
-
-        # Create labels, masking the prompt if required
-        labels = input_ids.clone()
-        if self.mask_prompt:
-            labels[: len(encoded_prompt)] = self.ignore_index
-
+        prompt_length = len(self.encoded_prompts[idx])
+        response_length = len(self.encoded_responses[idx])
         return {
-            "input_ids": input_ids,
-            "labels": labels,
-            "prompt_length": len(encoded_prompt),
-            "response_length": len(encoded_response),
+            "input_ids": self.input_ids[idx],
+            "prompt_length": prompt_length,
+            "response_length": response_length,
+            # Positions [label_start, label_end) of input_ids are trained on:
+            # the response and EOS token, plus the prompt unless masked.
+            "label_start": prompt_length if self.mask_prompt else 0,
+            "label_end": prompt_length + response_length + 1,
         }
 
 
@@ -202,20 +290,33 @@ def _sft_collate_fn(
     pad_id: int = 0,
     ignore_index: int = -100,
 ) -> Dict[str, torch.Tensor]:
-    """Collate function that pads sequences to max_seq_length."""
+    """Collate function that stacks sequences padded to max_seq_length.
+
+    SFTDataset already pads every example to max_seq_length, so this is
+    usually a plain stack; sequences of any other length are truncated and
+    padded here. Samples without labels get labels derived from their input
+    ids: only positions in [label_start, label_end) are kept, the rest are set
+    to ignore_index.
+    """
     batched = {}
     for key in ("input_ids", "labels"):
+        if key not in samples[0]:
+            continue
         pad_value = pad_id if key == "input_ids" else ignore_index
 
-        # Truncate and pad sequences
-        sequences = [sample[key][:max_seq_length] for sample in samples]
-        padded_sequences = [
-            torch.nn.functional.pad(
-                seq, (0, max_seq_length - len(seq)), value=pad_value
-            )
-            for seq in sequences
-        ]
-        batched[key] = torch.stack(padded_sequences)
+        sequences = [sample[key] for sample in samples]
+        if max_seq_length > 0 and any(
+            len(seq) != max_seq_length for seq in sequences
+        ):
+            sequences = [
+                torch.nn.functional.pad(
+                    seq[:max_seq_length],
+                    (0, max_seq_length - len(seq[:max_seq_length])),
+                    value=pad_value,
+                )
+                for seq in sequences
+            ]
+        batched[key] = torch.stack(sequences)
 
     # Process lengths
     for key in ("prompt_length", "response_length"):
@@ -226,4 +327,15 @@ def _sft_collate_fn(
 
         batched[key] = lengths
 
+    if "labels" not in batched:
+        input_ids = batched["input_ids"]
+        label_starts = torch.tensor([s["label_start"] for s in samples])
+        label_ends = torch.tensor([s["label_end"] for s in samples])
+
+        positions = torch.arange(input_ids.shape[1])
+        is_label = (positions >= label_starts[:, None]) & (
+            positions < label_ends[:, None]
+        )
+        batched["labels"] = torch.where(is_label, input_ids, ignore_index)
+
     return batched
@@ -12,8 +12,12 @@ import jax.tree_util as jtu
 from jax.sharding import NamedSharding, PartitionSpec as PS
 from .utils import named_tree_map
 
+import itertools
 import optax
 import os
+import torch
+import queue
+import threading
 
 from .checkpoint import (
     Checkpointer,
@@ -65,15 +69,29 @@ class TrainerConfig:
     mesh_shape: Optional[Tuple[int, int, int]] = None
 
     learning_rate: float = 1e-3
+    # Number of batches whose gradients are accumulated per optimizer update.
+    # Increases the effective batch size without increasing the device batch.
+    # num_steps (and the log/eval intervals) still count batches, i.e.
+    # micro-batches, not optimizer updates.
+    gradient_accumulation_steps: int = 1
 
     # lora configuration
     lora_rank: int = 4  # Rank for lora matrices
     use_lora: bool = False  # Enable or disable lora training
+    # Dtype of the frozen (non-lora) params during lora training; lora params
+    # stay in param_dtype. Set to None to keep the frozen params in param_dtype.
+    frozen_param_dtype: Optional[str] = "bfloat16"
 
     # Environment configuration
     base_dir: str = "/mnt/persistent-disk"
     hf_token: Optional[str] = None
 
+    # Number of preprocessed batches staged on device ahead of the training step
+    prefetch_batches: int = 2
+    # Number of training steps run per compiled call (via jax.lax.scan). Values
+    # above 1 amortize dispatch overhead, which matters for small models.
+    steps_per_call: int = 1
+
     # Logging configuration
     log_interval: int = 10
     eval_interval: int = 10
@@ -99,6 +117,12 @@ class Trainer:
         assert (
             trainer_config.model_name or model is not None
         ), "Either model_name must be provided in trainer_config or an existing model must be passed."
+        assert (
+            trainer_config.steps_per_call >= 1
+        ), "steps_per_call must be at least 1."
+        assert (
+            trainer_config.gradient_accumulation_steps >= 1
+        ), "gradient_accumulation_steps must be at least 1."
 
         self.trainer_config = trainer_config
         self.train_dataloader = train_dataloader
@@ -136,14 +160,28 @@ class Trainer:
                 use_optimized_decoder=trainer_config.use_optimized_decoder,
             )
 
-        model_params, model_static = eqx.partition(self.model, eqx.is_array)
+        # Shard the model params over the mesh, FSDP-style.
+        self.model = _shard_params(self.model, self.mesh)
 
         if trainer_config.use_lora:
-            # If using lora, create optimizer state only for the lora parameters.
-            # Step 1: Create filter spec to identify lora params in the model pytree.
             self.is_lora_param_filter_spec = _make_lora_params_filter_spec(
                 self.model
             )
+            # The frozen params get no gradients or optimizer updates, so
+            # storing them in lower precision halves their memory and
+            # bandwidth without affecting the lora updates.
+            if trainer_config.frozen_param_dtype is not None:
+                self.model = _cast_frozen_params(
+                    self.model,
+                    self.is_lora_param_filter_spec,
+                    jnp.dtype(trainer_config.frozen_param_dtype),
+                )
+
+        model_params, model_static = eqx.partition(self.model, eqx.is_array)
+
+        if trainer_config.use_lora:
+            # If using lora, create optimizer state only for the lora parameters.
+            # Step 1: Use the filter spec to identify lora params in the model pytree.
             # Step 2: Partition the model parameters into lora and non-lora params.
             lora_params, _ = eqx.partition(
                 model_params,
@@ -151,11 +189,34 @@ class Trainer:
                 is_leaf=eqx.is_array,
             )
             optimizer_params = lora_params
-            # TODO(lora): Add jax.lax.stop_gradient to non-lora params in the model tree.
         else:
             optimizer_params = model_params
 
         self.configure_optimizers(optimizer_params)
+        if trainer_config.gradient_accumulation_steps > 1:
+            # Wrap whatever optimizer configure_optimizers built (subclasses
+            # may override it). Accumulated gradients live in the optimizer
+            # state, so the compiled training step is unchanged.
+            self.optimizer = optax.MultiSteps(
+                self.optimizer,
+                every_k_schedule=trainer_config.gradient_accumulation_steps,
+            ).gradient_transformation()
+            self.opt_state = self.optimizer.init(optimizer_params)
+
+        self.opt_state_shardings = self._get_opt_state_shardings(
+            optimizer_params
+        )
+        self._jit_training_step = self._make_jit_training_step(
+            model_params, model_static, self.opt_state_shardings
+        )
+        if trainer_config.steps_per_call > 1:
+            self._jit_multi_training_step = self._make_jit_training_step(
+                model_params,
+                model_static,
+                self.opt_state_shardings,
+                step_fn=_multi_training_step,
+                batch_partition_spec=PS(None, "batch"),
+            )
 
     def configure_optimizers(self, optimizer_params):
         self.optimizer = optax.chain(
@@ -164,186 +225,232 @@ class Trainer:
         )
         self.opt_state = self.optimizer.init(optimizer_params)
 
-    def forward(self, model_params, model_static, batch):
-        model = eqx.combine(model_params, model_static)
-        input_ids = batch["input_ids"]
-        labels = batch["labels"]
-        attention_mask = batch.get("attention_mask", None)
-        position_ids = batch.get("position_ids", None)
+    def training_step(
+        self, trainable_params, frozen_params, optimizer_state, batch
+    ):
+        return self._jit_training_step(
+            trainable_params, frozen_params, optimizer_state, batch
+        )
 
-        logits = model(input_ids, attention_mask, position_ids)
+    def multi_training_step(
+        self, trainable_params, frozen_params, optimizer_state, batches
+    ):
+        return self._jit_multi_training_step(
+            trainable_params, frozen_params, optimizer_state, batches
+        )
 
-        # Shift for next-token prediction
-        shifted_logits = logits[..., :-1, :]
-        shifted_labels = labels[..., 1:]
+    def validation_step(self, model_params, model_static, batch):
+        return _validation_step(model_params, model_static, batch)
 
-        # If using attention mask, shift it too.
-        shifted_mask = None
-        if attention_mask is not None:
-            shifted_mask = attention_mask[..., 1:]
+    def _get_opt_state_shardings(self, optimizer_params):
+        """Returns the shardings of the optimizer state.
 
-        loss, accuracy = _cross_entropy_loss_and_accuracy(
-            shifted_logits, shifted_labels, shifted_mask
+        Param-shaped state (e.g. Adam moments) is sharded like the params it
+        tracks; everything else (e.g. step counts) is replicated.
+        """
+        return optax.tree_map_params(
+            self.optimizer,
+            lambda _, param: param.sharding,
+            self.opt_state,
+            optimizer_params,
+            transform_non_params=lambda _: NamedSharding(self.mesh, PS()),
         )
-        return loss, accuracy
 
-    @functools.partial(
-        jax.jit, static_argnames=("self", "model_static", "optimizer")
-    )
-    def training_step(
-        self, model_params, model_static, optimizer, optimizer_state, batch
+    def _make_jit_training_step(
+        self,
+        model_params,
+        model_static,
+        opt_state_shardings,
+        step_fn=None,
+        batch_partition_spec=PS("batch"),
     ):
-        grad_fn = jax.value_and_grad(self.forward, argnums=0, has_aux=True)
-        (loss, accuracy), grads = grad_fn(
-            model_params, model_static=model_static, batch=batch
-        )
+        """Compiles `step_fn` (`_training_step` by default) with explicit
+        in/out shardings.
 
-        if self.trainer_config.use_lora:
-            # If using lora, only extract gradients for the lora params.
-            # Step 1: Partition the gradients into lora and non-lora grads.
-            lora_grads, _ = eqx.partition(
-                grads,
-                filter_spec=self.is_lora_param_filter_spec,
-                is_leaf=eqx.is_array,
-            )
-            # Step 2: Partition the model parameters into lora and non-lora params.
-            lora_params, non_lora_params = eqx.partition(
-                model_params,
-                filter_spec=self.is_lora_param_filter_spec,
-                is_leaf=eqx.is_array,
-            )
-            # Step 3: Calculate updates to apply for each lora param using lora grad and apply them.
-            updates, optimizer_state = optimizer.update(
-                lora_grads, optimizer_state, lora_params
-            )
-            lora_params = optax.apply_updates(lora_params, updates)
-            # Step 4: Combine the updated lora params and non-lora params.
-            model_params = eqx.combine(lora_params, non_lora_params)
-        else:
-            # If not using lora, calculate updates to apply for all model params and apply them.
-            updates, optimizer_state = optimizer.update(
-                grads, optimizer_state, model_params
-            )
-            model_params = optax.apply_updates(model_params, updates)
+        Pinning the output shardings of the params and optimizer state to
+        their input shardings keeps them in place across steps, and lets XLA
+        insert (and overlap) the all-gathers and reduce-scatters for the
+        sharded params.
 
-        return loss, (accuracy, model_params, optimizer_state)
+        `model_static` is constant for the whole run, so it is closed over
+        rather than passed as a static argument: it is combined with the
+        params once at trace time, and never hashed on the per-step call path.
+        """
+        step_fn = step_fn or _training_step
+        trainable_params, frozen_params = self._partition_trainable_params(
+            model_params
+        )
+        trainable_shardings = jax.tree.map(
+            lambda x: x.sharding, trainable_params
+        )
+        frozen_shardings = jax.tree.map(lambda x: x.sharding, frozen_params)
+        replicated = NamedSharding(self.mesh, PS())
+        batch_sharding = NamedSharding(self.mesh, batch_partition_spec)
 
-    @functools.partial(
-        jax.jit,
-        static_argnames=("self", "model_static"),
-        donate_argnames=("batch",),
-    )
-    def validation_step(self, model_params, model_static, batch):
-        model = eqx.combine(model_params, model_static)
-        model = eqx.nn.inference_mode(model)
+        return jax.jit(
+            functools.partial(
+                step_fn,
+                model_static=model_static,
+                optimizer=self.optimizer,
+            ),
+            in_shardings=(
+                trainable_shardings,
+                frozen_shardings,
+                opt_state_shardings,
+                batch_sharding,
+            ),
+            out_shardings=(
+                replicated,
+                (replicated, trainable_shardings, opt_state_shardings),
+            ),
+            donate_argnums=(0, 2),
+        )
 
-        input_ids = batch["input_ids"]
-        labels = batch["labels"]
-        attention_mask = batch.get("attention_mask", None)
-        position_ids = batch.get("position_ids", None)
+    def _prepare_train_batches(self, batches):
+        """Preprocesses and shards a group of batches.
 
-        logits = model(input_ids, attention_mask, position_ids)
+        Returns the sharded batch and the number of steps it covers. Groups of
+        more than one batch are stacked along a new leading (step) axis for
+        `multi_training_step`, and sent to the devices in a single transfer.
+        """
+        batches = [_preprocess_batch(batch) for batch in batches]
+        if len(batches) == 1:
+            batch = host_local_array_to_global_array(
+                batches[0], self.mesh, PS("batch")
+            )
+            return batch, 1
 
-        # Shift for next-token prediction
-        shifted_logits = logits[..., :-1, :]
-        shifted_labels = labels[..., 1:]
+        batch = jax.tree.map(lambda *xs: jnp.stack(xs), *batches)
+        batch = host_local_array_to_global_array(
+            batch, self.mesh, PS(None, "batch")
+        )
+        return batch, len(batches)
 
-        # If using attention mask, shift it too.
-        shifted_mask = None
-        if attention_mask is not None:
-            shifted_mask = attention_mask[..., 1:]
+    def _partition_trainable_params(self, model_params):
+        """Splits model params into (trainable, frozen) params.
 
-        loss, accuracy = _cross_entropy_loss_and_accuracy(
-            shifted_logits, shifted_labels, shifted_mask
-        )
-        return loss, accuracy
+        When using lora, only the lora params are trainable, so gradients and
+        optimizer updates are never computed for the frozen base weights.
+        """
+        if self.trainer_config.use_lora:
+            filter_spec = self.is_lora_param_filter_spec
+        else:
+            filter_spec = eqx.is_array
+        return eqx.partition(model_params, filter_spec, is_leaf=eqx.is_array)
 
     def train(self):
         model_params, model_static = eqx.partition(self.model, eqx.is_array)
-        optimizer_state = self.opt_state
-        max_steps = self.trainer_config.num_steps or float("inf")
+        trainable_params, frozen_params = self._partition_trainable_params(
+            model_params
+        )
+        # Place the optimizer state once; the jitted step keeps its sharding.
+        optimizer_state = jax.device_put(
+            self.opt_state, self.opt_state_shardings
+        )
+        max_steps = self.trainer_config.num_steps or None
+        log_interval = self.trainer_config.log_interval
+        eval_interval = self.trainer_config.eval_interval
 
-        prev_step = 0
+        step, prev_step = 0, 0
         loss, accuracy = 0.0, 0.0
         val_loss, val_accuracy = 0.0, 0.0
         prev_loss, prev_accuracy = 0.0, 0.0
         prev_val_loss, prev_val_accuracy = 0.0, 0.0
 
-        for epoch in range(self.trainer_config.num_epochs):
-            print(
-                f"Started epoch {epoch + 1} of {self.trainer_config.num_epochs}..."
-            )
-
-            for step, batch in enumerate(self.train_dataloader):
-                if step >= max_steps:
-                    break
-
-                if (
-                    step == 1
-                    or (step + 1) % self.trainer_config.log_interval == 0
-                ):
-                    # Printing metrics of previous step to avoid disrupting XLA pipelining
-                    print(
-                        f"Step {prev_step} | "
-                        f"Train Loss: {prev_loss:.4f} | "
-                        f"Val Loss: {prev_val_loss:.4f} | "
-                        # f"Next Token Prediction Accuracy (train, val): {prev_accuracy:.2%}, {prev_val_accuracy:.2%}"
-                    )
-
-                pass
-
-                batch = _preprocess_batch(batch)
-                batch = host_local_array_to_global_array(
-                    batch, self.mesh, PS("batch")
-                )
-                optimizer_state = jax.device_put(
-                    optimizer_state, NamedSharding(self.mesh, PS())
+        try:
+            for epoch in range(self.trainer_config.num_epochs):
+                print(
+                    f"Started epoch {epoch + 1} of {self.trainer_config.num_epochs}..."
                 )
 
-                (
-                    loss,
-                    (accuracy, model_params, optimizer_state),
-                ) = self.training_step(
-                    model_params=model_params,
-                    model_static=model_static,
-                    optimizer=self.optimizer,
-                    optimizer_state=optimizer_state,
-                    batch=batch,
+                train_batches = _prefetch_batches(
+                    _group_batches(
+                        itertools.islice(self.train_dataloader, max_steps),
+                        self.trainer_config.steps_per_call,
+                    ),
+                    self._prepare_train_batches,
+                    size=self.trainer_config.prefetch_batches,
                 )
-
-                if self.trainer_config.eval_interval > 0 and (
-                    (step + 1) % self.trainer_config.eval_interval == 0
-                ):
-                    val_loss, val_accuracy = self.evaluate(
-                        model_params=model_params,
-                        model_static=model_static,
-                        max_eval_steps=self.trainer_config.eval_steps,
-                    )
-
-                if self.checkpointer and (
-                    (step + 1) % self.checkpointer.config.save_interval_steps
-                    == 0
-                ):
-                    self.save_checkpoint(
-                        step + 1,
-                        model_params,
-                        model_static,
-                        wait_until_finished=False,
-                    )
-
-                # Update previous step metrics, which will be used for logging.
-                prev_step = step
-                prev_loss, prev_accuracy = loss, accuracy
-                prev_val_loss, prev_val_accuracy = val_loss, val_accuracy
-
-        # Update the model with the trained parameters
-        self.model = eqx.combine(model_params, model_static)
+                step, num_calls = 0, 0
+                # Each iteration runs `num_batch_steps` training steps, starting
+                # at `step`, in a single compiled call.
+                for batch, num_batch_steps in train_batches:
+                    if num_calls > 0 and (
+                        num_calls == 1
+                        or _reaches_interval(step, num_batch_steps, log_interval)
+                    ):
+                        # Printing metrics of previous step to avoid disrupting XLA pipelining
+                        print(
+                            f"Step {prev_step} | "
+                            f"Train Loss: {prev_loss:.4f} | "
+                            f"Val Loss: {prev_val_loss:.4f} | "
+                            # f"Next Token Prediction Accuracy (train, val): {prev_accuracy:.2%}, {prev_val_accuracy:.2%}"
+                        )
+
+                    if num_batch_steps == 1:
+                        (
+                            loss,
+                            (accuracy, trainable_params, optimizer_state),
+                        ) = self.training_step(
+                            trainable_params=trainable_params,
+                            frozen_params=frozen_params,
+                            optimizer_state=optimizer_state,
+                            batch=batch,
+                        )
+                    else:
+                        (
+                            losses,
+                            (accuracies, trainable_params, optimizer_state),
+                        ) = self.multi_training_step(
+                            trainable_params=trainable_params,
+                            frozen_params=frozen_params,
+                            optimizer_state=optimizer_state,
+                            batches=batch,
+                        )
+                        loss, accuracy = losses[-1], accuracies[-1]
+                    num_calls += 1
+
+                    if eval_interval > 0 and _reaches_interval(
+                        step, num_batch_steps, eval_interval
+                    ):
+                        val_loss, val_accuracy = self.evaluate(
+                            model_params=eqx.combine(
+                                trainable_params, frozen_params
+                            ),
+                            model_static=model_static,
+                            max_eval_steps=self.trainer_config.eval_steps,
+                        )
+
+                    if self.checkpointer and _reaches_interval(
+                        step,
+                        num_batch_steps,
+                        self.checkpointer.config.save_interval_steps,
+                    ):
+                        self.save_checkpoint(
+                            step + num_batch_steps,
+                            eqx.combine(trainable_params, frozen_params),
+                            model_static,
+                            wait_until_finished=False,
+                        )
+
+                    # Update previous step metrics, which will be used for logging.
+                    step += num_batch_steps
+                    prev_step = step - 1
+                    prev_loss, prev_accuracy = loss, accuracy
+                    prev_val_loss, prev_val_accuracy = val_loss, val_accuracy
+        finally:
+            # Write the latest params and optimizer state back even if training
+            # stops early: the arrays they replace were donated to the training
+            # step and are no longer valid.
+            model_params = eqx.combine(trainable_params, frozen_params)
+            self.model = eqx.combine(model_params, model_static)
+            self.opt_state = optimizer_state
         print("Training completed!")
 
         # Save final checkpoint
         if self.checkpointer:
             self.save_checkpoint(
-                step + 1, model_params, model_static, wait_until_finished=True
+                step, model_params, model_static, wait_until_finished=True
             )
             print("Final checkpoint saved at:", self.checkpointer.directory)
 
@@ -435,15 +542,255 @@ class Trainer:
         print("Hugging Face model saved at:", export_dir)
 
 
+def _prefetch_batches(batches, prepare_fn, size=2):
+    """Yields `prepare_fn(batch)` for each batch, preparing up to `size` batches
+    ahead in a background thread.
+
+    This overlaps host-side data loading and host-to-device transfers with the
+    (asynchronously dispatched) training step.
+    """
+    if size <= 0:
+        yield from map(prepare_fn, batches)
+        return
+
+    batch_queue = queue.Queue(maxsize=size)
+    stop = threading.Event()
+    end_of_data = object()
+
+    def _put(item):
+        while not stop.is_set():
+            try:
+                batch_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _producer():
+        try:
+            for batch in batches:
+                if not _put(prepare_fn(batch)):
+                    return
+        except BaseException as e:
+            _put(e)
+        finally:
+            # Always signal the end, so the consumer never blocks forever on a
+            # producer that has exited.
+            _put(end_of_data)
+
+    thread = threading.Thread(target=_producer, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = batch_queue.get()
+            if item is end_of_data:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        # Unblocks the producer if the consumer stops early, e.g. at num_steps.
+        stop.set()
+        thread.join()
+
+
+def _group_batches(batches, group_size):
+    """Groups consecutive batches into lists of up to `group_size` batches.
+
+    A group is cut short when the next batch has different shapes (e.g. a
+    smaller final batch), since the batches of a group are stacked together.
+    """
+    group = []
+    for batch in batches:
+        if group and (
+            len(group) == group_size
+            or _batch_shapes(batch) != _batch_shapes(group[0])
+        ):
+            yield group
+            group = []
+        group.append(batch)
+    if group:
+        yield group
+
+
+def _batch_shapes(batch):
+    return {k: tuple(v.shape) for k, v in batch.items()}
+
+
+def _reaches_interval(step, num_steps, interval):
+    """Whether any of the steps [step, step + num_steps) is the last step of an
+    `interval`, i.e. satisfies (s + 1) % interval == 0."""
+    return (step + num_steps) // interval > step // interval
+
+
+def _forward(model, batch):
+    input_ids = batch["input_ids"]
+    attention_mask = batch.get("attention_mask", None)
+    position_ids = batch.get("position_ids", None)
+    if position_ids is None:
+        # Built inside the compiled step, where the shape is static, so XLA
+        # folds it into its consumers instead of it being sent with each batch.
+        position_ids = jnp.broadcast_to(
+            jnp.arange(input_ids.shape[1], dtype=jnp.int32), input_ids.shape
+        )
+
+    logits = model(input_ids, attention_mask, position_ids)
+
+    # Labels were already shifted for next-token prediction by
+    # _preprocess_batch; the last position has no next token to predict.
+    return _cross_entropy_loss_and_accuracy(
+        logits[:, :-1], batch["labels"], batch["label_mask"]
+    )
+
+
+def _training_step(
+    trainable_params,
+    frozen_params,
+    optimizer_state,
+    batch,
+    model_static,
+    optimizer,
+):
+    """Runs one forward/backward pass and optimizer update.
+
+    Compiled per trainer by `Trainer._make_jit_training_step`, which donates
+    the trainable params and optimizer state so XLA updates them in place.
+    """
+
+    def loss_fn(trainable_params):
+        model = eqx.combine(trainable_params, frozen_params, model_static)
+        return _forward(model, batch)
+
+    grad_fn = jax.value_and_grad(loss_fn, has_aux=True)
+    (loss, accuracy), grads = grad_fn(trainable_params)
+
+    updates, optimizer_state = optimizer.update(
+        grads, optimizer_state, trainable_params
+    )
+    trainable_params = optax.apply_updates(trainable_params, updates)
+    return loss, (accuracy, trainable_params, optimizer_state)
+
+
+def _multi_training_step(
+    trainable_params,
+    frozen_params,
+    optimizer_state,
+    batches,
+    model_static,
+    optimizer,
+):
+    """Runs `_training_step` once per batch in `batches` (stacked along a
+    leading axis) with `jax.lax.scan`, so several steps run in one compiled
+    call. Returns the per-step losses and accuracies."""
+
+    def scan_fn(carry, batch):
+        trainable_params, optimizer_state = carry
+        loss, (accuracy, trainable_params, optimizer_state) = _training_step(
+            trainable_params,
+            frozen_params,
+            optimizer_state,
+            batch,
+            model_static,
+            optimizer,
+        )
+        return (trainable_params, optimizer_state), (loss, accuracy)
+
+    (trainable_params, optimizer_state), (losses, accuracies) = jax.lax.scan(
+        scan_fn, (trainable_params, optimizer_state), batches
+    )
+    return losses, (accuracies, trainable_params, optimizer_state)
+
+
+@functools.partial(
+    jax.jit,
+    static_argnames=("model_static",),
+    donate_argnames=("batch",),
+)
+def _validation_step(model_params, model_static, batch):
+    model = eqx.combine(model_params, model_static)
+    model = eqx.nn.inference_mode(model)
+    return _forward(model, batch)
+
+
+def _get_param_sharding(mesh, x):
+    """Returns the FSDP sharding for a parameter array.
+
+    Params that are already sharded over `mesh` keep their sharding. Otherwise
+    the trailing two axes are sharded over ("fsdp", "mp") (the last axis over
+    "fsdp" for 1D params) wherever they divide evenly, and replicated elsewhere.
+    """
+    if isinstance(x.sharding, NamedSharding) and x.sharding.mesh == mesh:
+        return x.sharding
+
+    mesh_axes = ("fsdp", "mp")[: x.ndim]
+    spec = [None] * (x.ndim - len(mesh_axes))
+    for dim_size, mesh_axis in zip(x.shape[-len(mesh_axes) :], mesh_axes):
+        spec.append(mesh_axis if dim_size % mesh.shape[mesh_axis] == 0 else None)
+    return NamedSharding(mesh, PS(*spec))
+
+
+def _shard_params(model, mesh):
+    """Places every array in `model` according to `_get_param_sharding`."""
+    params, static = eqx.partition(model, eqx.is_array)
+    shardings = jax.tree.map(
+        functools.partial(_get_param_sharding, mesh), params
+    )
+    return eqx.combine(jax.device_put(params, shardings), static)
+
+
+def _cast_frozen_params(model, is_lora_param_filter_spec, dtype):
+    """Casts the frozen LlamaLinear weights and biases of `model` to `dtype`.
+
+    Only the linear projections are cast; embeddings, norm weights and the
+    rotary `inv_freq` keep the dtype they were loaded with.
+    """
+    lora_params, frozen_params = eqx.partition(
+        model, is_lora_param_filter_spec, is_leaf=eqx.is_array
+    )
+
+    def cast_fn(module):
+        if not isinstance(module, LlamaLinear):
+            return module
+        return jax.tree.map(
+            lambda x: x.astype(dtype) if eqx.is_inexact_array(x) else x,
+            module,
+        )
+
+    frozen_params = jtu.tree_map(
+        cast_fn, frozen_params, is_leaf=lambda x: isinstance(x, LlamaLinear)
+    )
+    return eqx.combine(lora_params, frozen_params)
+
+
+@eqx.filter_jit(donate="all")
 def _merge_lora_params(model):
+    """Folds the lora updates into the base weights of every LlamaLinear.
+
+    The whole model is merged in one jitted computation, so XLA schedules all
+    the per-layer updates together instead of dispatching them one by one.
+    The input model's arrays are donated, so the old and merged weights are
+    not both kept alive; `model` must not be used afterwards.
+    """
+
     def merge_fn(module):
         if (
             isinstance(module, LlamaLinear)
             and module.lora_A is not None
             and module.lora_B is not None
         ):
-            delta_weight = module.lora_A @ module.lora_B.T
-            new_weight = module.weight + delta_weight
+            # y = x @ W.T + (x @ A @ B) * scaling, so W += (A @ B).T * scaling.
+            # matmul/swapaxes also cover weights stacked over a layer axis.
+            delta_weight = jnp.swapaxes(
+                module.lora_A.astype(jnp.float32)
+                @ module.lora_B.astype(jnp.float32),
+                -1,
+                -2,
+            ) * (module.alpha / module.rank)
+            # Merge into param_dtype rather than the (possibly lower
+            # precision) dtype the frozen weight was stored in for training.
+            new_weight = (
+                module.weight.astype(jnp.float32) + delta_weight
+            ).astype(module.param_dtype)
             module = eqx.tree_at(lambda m: m.weight, module, new_weight)
 
             # Optionally set lora_A and lora_B to None
@@ -452,26 +799,39 @@ def _merge_lora_params(model):
             )
         return module
 
-    model = jtu.tree_map(merge_fn, model, is_leaf=eqx.is_array)
+    model = jtu.tree_map(
+        merge_fn, model, is_leaf=lambda x: isinstance(x, LlamaLinear)
+    )
     return model
 
 
 def _preprocess_batch(batch):
-    # Convert PyTorch tensors to JAX arrays
+    # Convert PyTorch tensors to JAX arrays. DLPack hands the tensor's host
+    # buffer to JAX without a copy; the only copy is the later transfer of the
+    # (sharded) batch to the devices.
     batch = {
-        k: v if isinstance(v, jax.Array) else jax.numpy.array(v.numpy())
+        k: jax.dlpack.from_dlpack(v.contiguous())
+        if isinstance(v, torch.Tensor)
+        else jnp.asarray(v)
         for k, v in batch.items()
     }
+    return _jit_preprocess_batch(batch)
+
+
+@jax.jit
+def _jit_preprocess_batch(batch):
     batch["input_ids"] = batch["input_ids"].astype(jnp.int32)
-    batch["labels"] = batch["labels"].astype(jnp.int32)
-
-    # Add position IDs to batch
-    seq_length = batch["input_ids"].shape[1]
-    batch["position_ids"] = jnp.repeat(
-        jnp.arange(seq_length)[None, :],
-        batch["input_ids"].shape[0],
-        axis=0,
-    )
+
+    # Shift labels for next-token prediction. Negative labels (the dataset's
+    # ignore_index) and padded positions are masked out of the loss, and
+    # replaced by a valid token id so the loss never gathers out of bounds.
+    labels = batch["labels"][:, 1:].astype(jnp.int32)
+    label_mask = labels >= 0
+    if "attention_mask" in batch:
+        label_mask &= batch["attention_mask"][:, 1:] > 0
+    batch["labels"] = jnp.where(label_mask, labels, 0)
+    batch["label_mask"] = label_mask.astype(jnp.int32)
+
     return batch
 
 
@@ -483,24 +843,16 @@ def _make_lora_params_filter_spec(model):
     )
 
 
-def _cross_entropy_loss_and_accuracy(logits, tokens, mask=None):
-    if mask is None:
-        mask = jnp.ones(tokens.shape[:2])
+def _cross_entropy_loss_and_accuracy(logits, tokens, mask):
     mask = mask.astype(jnp.float32)
 
     valid_text_length = jnp.maximum(jnp.sum(mask, axis=-1), 1e-10)
 
     logits = logits.astype(jnp.float32)  # for numerical stability
-    token_log_prob = jnp.squeeze(
-        jnp.take_along_axis(
-            jax.nn.log_softmax(logits, axis=-1),
-            jnp.expand_dims(tokens, -1),
-            axis=-1,
-        ),
-        -1,
-    )
-    token_log_prob = jnp.where(mask > 0.0, token_log_prob, jnp.array(0.0))
-    loss = -jnp.mean(jnp.sum(token_log_prob, axis=-1) / valid_text_length)
+    # Fused logsumexp - label logit, avoiding a full log_softmax over the vocab.
+    token_loss = optax.softmax_cross_entropy_with_integer_labels(logits, tokens)
+    token_loss = jnp.where(mask > 0.0, token_loss, jnp.array(0.0))
+    loss = jnp.mean(jnp.sum(token_loss, axis=-1) / valid_text_length)
     correct = jnp.where(
         mask > 0.0, jnp.argmax(logits, axis=-1) == tokens, jnp.array(False)
     )
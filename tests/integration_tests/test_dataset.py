@@ -263,3 +263,56 @@ def test_sequences_padded_to_max_length(tokenizer):
         assert (
             labels[last_label_pos + 1 :] == config.ignore_index
         ).all(), "labels padding values are incorrect"
+
+
+class _WhitespaceTokenizer:
+    """Minimal offline tokenizer: one id per whitespace-separated word."""
+
+    bos_token_id = 1
+    eos_token_id = 2
+    pad_token_id = 0
+
+    def __call__(self, texts, add_special_tokens=True, **kwargs):
+        input_ids = []
+        for text in texts:
+            ids = [3 + len(word) for word in text.split()]
+            if add_special_tokens:
+                ids = [self.bos_token_id] + ids
+            input_ids.append(ids)
+        return {"input_ids": input_ids}
+
+
+@pytest.mark.parametrize("mask_prompt", [False, True])
+def test_collate_derives_labels_from_label_span(mask_prompt):
+    """Tests the labels derived by the collate function for both mask_prompt
+    settings."""
+    config = DatasetConfig(
+        batch_size=2,
+        max_seq_length=32,
+        num_workers=0,
+        mask_prompt=mask_prompt,
+    )
+    data = [
+        {"instruction": "add two numbers", "output": "four"},
+        {"instruction": "say hi", "output": "hello there friend"},
+    ]
+    dataset = SFTDataset(
+        config=config, data=data, tokenizer=_WhitespaceTokenizer()
+    )
+    batch = next(iter(create_dataloader(config=config, dataset=dataset)))
+
+    for i in range(len(data)):
+        input_ids = batch["input_ids"][i].numpy()
+        labels = batch["labels"][i].numpy()
+        prompt_length = batch["prompt_length"][i].item()
+        sequence_length = prompt_length + batch["response_length"][i].item() + 1
+        label_start = prompt_length if mask_prompt else 0
+
+        eos_token_id = _WhitespaceTokenizer.eos_token_id
+        assert input_ids[sequence_length - 1] == eos_token_id
+        np.testing.assert_array_equal(
+            labels[label_start:sequence_length],
+            input_ids[label_start:sequence_length],
+        )
+        assert (labels[:label_start] == config.ignore_index).all()
+        assert (labels[sequence_length:] == config.ignore_index).all()
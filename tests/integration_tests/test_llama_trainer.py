@@ -1,9 +1,26 @@
 from src.felafax.trainer_engine.models.llama3.jax.model import (
     LlamaConfig,
     LlamaForCausalLM,
+    LlamaLinear,
 )
-from src.felafax.trainer_engine.trainer import Trainer, TrainerConfig
+from src.felafax.trainer_engine.trainer import (
+    Trainer,
+    TrainerConfig,
+    _cross_entropy_loss_and_accuracy,
+    _merge_lora_params,
+    _prefetch_batches,
+    _preprocess_batch,
+)
+from tokenizers import Tokenizer, models
+from transformers import PreTrainedTokenizerFast
+import equinox as eqx
+import itertools
+import numpy as np
+import optax
+import pytest
+import threading
 import jax.numpy as jnp
+import jax.tree_util as jtu
 import jax
 
 
@@ -31,6 +48,21 @@ def dummy_data_loader(batch_size, seq_length):
         }
 
 
+def _get_tiny_model_config(lora_rank=0):
+    model_config = LlamaConfig(
+        model_name="tiny",
+        vocab_size=100,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        num_key_value_heads=2,
+        max_position_embeddings=128,
+    )
+    model_config.lora_rank = lora_rank
+    return model_config
+
+
 def test_llama_trainer():
     """Tests the end-to-end run of the trainer without checkpointing."""
     # Create a tiny model configuration using LlamaConfig
@@ -87,3 +119,346 @@ def test_llama_trainer():
 
     # Run training
     trainer.train()
+
+
+def test_merge_lora_params():
+    """Tests that merging lora params into the base weights preserves outputs."""
+    model_config = _get_tiny_model_config(lora_rank=4)
+    model = LlamaForCausalLM(
+        model_config, param_dtype=jnp.float32, compute_dtype=jnp.float32
+    )
+    # lora_B is initialized to zeros; make every lora_B (including the ones
+    # stacked over layers) non-zero so the merge matters.
+    keys = iter(jax.random.split(jax.random.PRNGKey(1), 16))
+
+    def randomize_lora_B(module):
+        if not isinstance(module, LlamaLinear):
+            return module
+        lora_B = 0.1 * jax.random.normal(next(keys), module.lora_B.shape)
+        return eqx.tree_at(lambda m: m.lora_B, module, lora_B)
+
+    model = jtu.tree_map(
+        randomize_lora_B, model, is_leaf=lambda x: isinstance(x, LlamaLinear)
+    )
+
+    input_ids, attention_mask, position_ids = _get_dummy_data(2, 16)
+    # _merge_lora_params donates the model, so compute its outputs first.
+    expected_logits = model(input_ids, attention_mask, position_ids)
+    merged_model = _merge_lora_params(model)
+
+    merged_linears = [
+        leaf
+        for leaf in jax.tree.leaves(
+            merged_model, is_leaf=lambda x: isinstance(x, LlamaLinear)
+        )
+        if isinstance(leaf, LlamaLinear)
+    ]
+    assert merged_linears
+    assert all(
+        linear.lora_A is None and linear.lora_B is None
+        for linear in merged_linears
+    )
+    assert jnp.allclose(
+        expected_logits,
+        merged_model(input_ids, attention_mask, position_ids),
+        atol=1e-4,
+    )
+
+
+def test_cast_frozen_params_only_casts_linear_weights():
+    """Tests that only the frozen linear weights are stored in bfloat16."""
+    model_config = _get_tiny_model_config(lora_rank=8)
+    model = LlamaForCausalLM(
+        model_config, param_dtype=jnp.float32, compute_dtype=jnp.float32
+    )
+    trainer_config = TrainerConfig(
+        model_name="",
+        num_steps=1,
+        num_tpus=jax.device_count(),
+        use_lora=True,
+        lora_rank=8,
+        frozen_param_dtype="bfloat16",
+        param_dtype="float32",
+        compute_dtype="float32",
+    )
+    trainer = Trainer(
+        trainer_config=trainer_config,
+        train_dataloader=dummy_data_loader(8, 16),
+        val_dataloader=dummy_data_loader(8, 16),
+        model=model,
+        model_config=model_config,
+    )
+
+    layers = trainer.model.model.layers
+    assert layers.self_attn.q_proj.weight.dtype == jnp.bfloat16
+    assert layers.self_attn.q_proj.lora_A.dtype == jnp.float32
+    assert layers.self_attn.rotary_emb.inv_freq.dtype == jnp.float32
+    assert layers.input_layernorm.weight.dtype == jnp.float32
+    assert trainer.model.model.embed_tokens.weight.dtype == jnp.float32
+    assert trainer.model.model.norm.weight.dtype == jnp.float32
+
+    # Merging lora params restores the linear weights to param_dtype.
+    merged_model = _merge_lora_params(trainer.model)
+    assert merged_model.model.layers.self_attn.q_proj.weight.dtype == (
+        jnp.float32
+    )
+
+
+def test_loss_ignores_masked_and_padded_labels():
+    """Tests that ignore_index and padded labels are excluded from the loss."""
+    vocab_size = 8
+    input_ids = np.array([[1, 5, 6, 7, 2, 0], [1, 3, 4, 2, 0, 0]])
+    # The first example masks its prompt; both are right-padded.
+    labels = np.array([[-100, -100, 6, 7, 2, -100], [1, 3, 4, 2, -100, -100]])
+    attention_mask = (input_ids != 0).astype(np.int32)
+    batch = _preprocess_batch(
+        {
+            "input_ids": input_ids,
+            "labels": labels,
+            "attention_mask": attention_mask,
+        }
+    )
+    logits = jax.random.normal(
+        jax.random.PRNGKey(0), input_ids.shape + (vocab_size,)
+    )
+    loss, accuracy = _cross_entropy_loss_and_accuracy(
+        logits[:, :-1], batch["labels"], batch["label_mask"]
+    )
+
+    # Per-example mean over the valid (shifted) labels, averaged over the batch.
+    log_probs = np.asarray(jax.nn.log_softmax(logits[:, :-1]))
+    expected_losses = []
+    for i in range(labels.shape[0]):
+        valid = np.nonzero(labels[i, 1:] >= 0)[0]
+        token_losses = -log_probs[i, valid, labels[i, 1 + valid]]
+        expected_losses.append(token_losses.mean())
+
+    assert jnp.isfinite(loss)
+    assert jnp.isfinite(accuracy)
+    assert jnp.allclose(loss, np.mean(expected_losses), atol=1e-5)
+
+
+def _random_data_loader(batch_size, seq_length, vocab_size, num_batches):
+    key = jax.random.PRNGKey(1)
+    for _ in range(num_batches):
+        key, subkey = jax.random.split(key)
+        input_ids = jax.random.randint(
+            subkey, (batch_size, seq_length), 0, vocab_size, dtype=jnp.int32
+        )
+        yield {
+            "input_ids": input_ids,
+            "labels": input_ids,
+            "attention_mask": jnp.ones_like(input_ids),
+        }
+
+
+def test_steps_per_call_matches_single_steps():
+    """Tests that running several steps per compiled call gives the same final
+    params as running one step per call."""
+    model_config = _get_tiny_model_config(lora_rank=4)
+    num_steps = 10
+
+    final_params = []
+    for steps_per_call in (1, 3, 4):
+        model = LlamaForCausalLM(
+            model_config,
+            param_dtype=jnp.float32,
+            compute_dtype=jnp.float32,
+            key=jax.random.PRNGKey(0),
+        )
+        trainer_config = TrainerConfig(
+            model_name="",
+            num_steps=num_steps,
+            num_tpus=jax.device_count(),
+            use_lora=True,
+            lora_rank=4,
+            learning_rate=1e-2,
+            steps_per_call=steps_per_call,
+            eval_interval=0,
+            base_dir="/tmp/test_trainer/",
+            param_dtype="float32",
+            compute_dtype="float32",
+        )
+        trainer = Trainer(
+            trainer_config=trainer_config,
+            train_dataloader=_random_data_loader(8, 16, 100, num_steps),
+            val_dataloader=None,
+            model=model,
+            model_config=model_config,
+        )
+        trainer.train()
+        lora_params, _ = eqx.partition(
+            trainer.model, trainer.is_lora_param_filter_spec
+        )
+        final_params.append(jax.tree.leaves(lora_params))
+
+    for params in final_params[1:]:
+        for expected, actual in zip(final_params[0], params):
+            assert jnp.allclose(expected, actual, atol=1e-5)
+
+
+def _failing_data_loader(batch_size, seq_length, num_batches):
+    yield from itertools.islice(
+        dummy_data_loader(batch_size, seq_length), num_batches
+    )
+    raise ValueError("corrupt batch")
+
+
+def test_export_after_interrupted_training(tmp_path):
+    """Tests that the model can still be exported after training stops early,
+    even though the training step donates the params and optimizer state."""
+    # Save a local tokenizer, so export does not need to download one.
+    tokenizer_dir = str(tmp_path / "tokenizer")
+    PreTrainedTokenizerFast(
+        tokenizer_object=Tokenizer(
+            models.WordLevel({"<unk>": 0}, unk_token="<unk>")
+        )
+    ).save_pretrained(tokenizer_dir)
+
+    model_config = _get_tiny_model_config(lora_rank=4)
+    model = LlamaForCausalLM(
+        model_config, param_dtype=jnp.float32, compute_dtype=jnp.float32
+    )
+    trainer_config = TrainerConfig(
+        model_name=tokenizer_dir,
+        num_steps=5,
+        num_tpus=jax.device_count(),
+        use_lora=True,
+        lora_rank=4,
+        eval_interval=0,
+        base_dir=str(tmp_path),
+        param_dtype="float32",
+        compute_dtype="float32",
+    )
+    trainer = Trainer(
+        trainer_config=trainer_config,
+        train_dataloader=_failing_data_loader(8, 16, num_batches=2),
+        val_dataloader=None,
+        model=model,
+        model_config=model_config,
+    )
+
+    with pytest.raises(ValueError, match="corrupt batch"):
+        trainer.train()
+
+    # The params and optimizer state of the last completed step are kept.
+    leaves = jax.tree.leaves(
+        eqx.filter((trainer.model, trainer.opt_state), eqx.is_array)
+    )
+    assert not any(leaf.is_deleted() for leaf in leaves)
+    trainer.export(str(tmp_path / "hf_export"))
+
+
+class _SGDTrainer(Trainer):
+    """Trainer using plain SGD.
+
+    Adam's early updates are close to lr * sign(grad), which amplifies float
+    rounding in near-zero gradients, so SGD is used to compare params across
+    equivalent training setups.
+    """
+
+    def configure_optimizers(self, optimizer_params):
+        self.optimizer = optax.sgd(
+            learning_rate=self.trainer_config.learning_rate
+        )
+        self.opt_state = self.optimizer.init(optimizer_params)
+
+
+def _train_and_get_params(
+    model_config, train_dataloader, trainer_cls=Trainer, **config_kwargs
+):
+    model = LlamaForCausalLM(
+        model_config,
+        param_dtype=jnp.float32,
+        compute_dtype=jnp.float32,
+        key=jax.random.PRNGKey(0),
+    )
+    trainer_config = TrainerConfig(
+        model_name="",
+        num_tpus=jax.device_count(),
+        lora_rank=model_config.lora_rank,
+        learning_rate=1e-3,
+        eval_interval=0,
+        base_dir="/tmp/test_trainer/",
+        param_dtype="float32",
+        compute_dtype="float32",
+        **config_kwargs,
+    )
+    trainer = trainer_cls(
+        trainer_config=trainer_config,
+        train_dataloader=train_dataloader,
+        val_dataloader=None,
+        model=model,
+        model_config=model_config,
+    )
+    trainer.train()
+    return jax.tree.leaves(eqx.filter(trainer.model, eqx.is_array))
+
+
+@pytest.mark.parametrize(
+    "use_lora, steps_per_call", [(True, 1), (False, 1), (True, 3), (False, 3)]
+)
+def test_gradient_accumulation_matches_larger_batch(use_lora, steps_per_call):
+    """Tests that accumulating gradients over 2 batches of size B gives the
+    same params as training on batches of size 2B."""
+    model_config = _get_tiny_model_config(lora_rank=4 if use_lora else 0)
+    num_updates = 2
+    batches = list(_random_data_loader(8, 16, 100, num_updates))
+    micro_batches = [
+        {key: value[i : i + 4] for key, value in batch.items()}
+        for batch in batches
+        for i in (0, 4)
+    ]
+
+    expected_params = _train_and_get_params(
+        model_config,
+        iter(batches),
+        trainer_cls=_SGDTrainer,
+        num_steps=num_updates,
+        use_lora=use_lora,
+    )
+    params = _train_and_get_params(
+        model_config,
+        iter(micro_batches),
+        trainer_cls=_SGDTrainer,
+        num_steps=2 * num_updates,
+        use_lora=use_lora,
+        gradient_accumulation_steps=2,
+        steps_per_call=steps_per_call,
+    )
+
+    for expected, actual in zip(expected_params, params):
+        assert jnp.allclose(expected, actual, atol=1e-5)
+
+
+def test_prefetch_batches_reraises_source_errors():
+    """Tests that an error raised by the source reaches the consumer."""
+
+    def batches():
+        yield 1
+        raise ValueError("corrupt batch")
+
+    prefetched = _prefetch_batches(batches(), lambda x: x * 10)
+    assert next(prefetched) == 10
+    with pytest.raises(ValueError, match="corrupt batch"):
+        next(prefetched)
+
+
+def test_prefetch_batches_joins_producer_on_close():
+    """Tests that closing the consumer early stops the producer thread."""
+    producer_threads = []
+
+    def prepare_fn(batch):
+        producer_threads.append(threading.current_thread())
+        return batch
+
+    prefetched = _prefetch_batches(itertools.count(), prepare_fn, size=2)
+    assert next(prefetched) == 0
+    prefetched.close()
+
+    assert not producer_threads[0].is_alive()
+
+
+def test_prefetch_batches_empty_source():
+    """Tests that an empty source ends cleanly."""
+    assert list(_prefetch_batches(iter([]), lambda x: x)) == []